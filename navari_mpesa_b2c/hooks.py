@@ -18,6 +18,7 @@ fixtures = [
                     "Employee Advance",
                     "Salary Slip",
                     "Purchase Invoice",
+                    "Mpesa Settings",
                 ),
             ],
             ["module", "=", "MPesa B2C"],
@@ -173,6 +174,10 @@ before_uninstall = (
 # 	],
 # }
 
+scheduler_events = {
+    "daily": ["navari_mpesa_b2c.mpesa_b2c.utils.helpers.delete_expired_access_tokens"],
+}
+
 # Testing
 # -------
 
@@ -38,3 +38,7 @@ class InformationMismatchError(Exception):
     Raised when there's a mismatch in any of the B2C Payment's records
     and the corresponding B2C Payments Transaction's records
     """
+
+
+class DarajaCircuitOpenError(Exception):
+    """Raised when Daraja requests are short-circuited after repeated consecutive failures"""
@@ -6,7 +6,11 @@ from datetime import datetime
 import frappe
 from frappe.model.document import Document
 
-from ...scripts.server.mpesa_connector import MpesaB2CConnector
+from ...scripts.server.mpesa_connector import (
+    DEFAULT_BASE_DELAY,
+    DEFAULT_MAX_RETRIES,
+    MpesaB2CConnector,
+)
 from .. import app_logger
 from ..custom_exceptions import InvalidTokenExpiryTimeError
 
@@ -32,6 +36,25 @@ class DarajaAccessTokens(Document):
         auth_response = MpesaB2CConnector(
             app_key=mpesa_setting.consumer_key,
             app_secret=mpesa_setting.get_password("consumer_secret"),
+            max_retries=(
+                DEFAULT_MAX_RETRIES
+                if mpesa_setting.custom_b2c_max_retries is None
+                else mpesa_setting.custom_b2c_max_retries
+            ),
+            base_delay=(
+                DEFAULT_BASE_DELAY
+                if mpesa_setting.custom_b2c_base_delay is None
+                else mpesa_setting.custom_b2c_base_delay
+            ),
         ).authenticate(setting=mpesa_setting.name)
 
         return auth_response
+
+
+def on_doctype_update() -> None:
+    """Index the columns used to look up a setting's valid access token"""
+    frappe.db.add_index(
+        "Daraja Access Tokens",
+        ["associated_settings", "expiry_time"],
+        index_name="associated_settings_expiry_time_index",
+    )
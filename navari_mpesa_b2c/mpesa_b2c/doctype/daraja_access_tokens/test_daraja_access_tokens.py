@@ -2,23 +2,26 @@
 # See license.txt
 
 import datetime
-import json
 from unittest.mock import MagicMock, patch
 
-import frappe
 import requests
+
+import frappe
+from frappe.query_builder import Table
 from frappe.tests.utils import FrappeTestCase
 from frappe.utils.password import get_decrypted_password
 
+from ...scripts.server import base_classes, mpesa_connector
+from ...scripts.server.mpesa_connector import MpesaB2CConnector
+from ...utils import helpers
 from ..custom_exceptions import InvalidTokenExpiryTimeError
-from ..mpesa_b2c_payment import mpesa_b2c_payment
-from ..mpesa_b2c_payment.mpesa_b2c_payment import (
-    get_access_tokens,
-    get_hashed_token,
-    save_access_token_to_database,
+from ..mpesa_b2c_payment.test_mpesa_b2c_payment import (
+    get_b2c_request_data,
+    get_response,
 )
 
 TOKEN_ACCESS_TIME = datetime.datetime.now()
+TEST_SETTING = "Test Mpesa Setting"
 
 
 def create_access_token() -> None:
@@ -41,6 +44,27 @@ def create_access_token() -> None:
     frappe.flags.test_events_created = True
 
 
+def create_setting_access_token(
+    access_token: str,
+    token_fetch_time: datetime.datetime,
+    expiry_time: datetime.datetime,
+) -> int:
+    """Creates an access token record of the test setting, returning its name"""
+    return (
+        frappe.get_doc(
+            {
+                "doctype": "Daraja Access Tokens",
+                "associated_settings": TEST_SETTING,
+                "access_token": access_token,
+                "token_fetch_time": token_fetch_time,
+                "expiry_time": expiry_time,
+            }
+        )
+        .insert(ignore_links=True)
+        .name
+    )
+
+
 class TestDarajaAccessTokens(FrappeTestCase):
     """Testing the Daraja Access Tokens doctype"""
 
@@ -103,88 +127,254 @@ class TestDarajaAccessTokens(FrappeTestCase):
                 }
             ).insert()
 
-    def test_get_hashed_token(self) -> None:
-        """Tests the get_hashed_token() function from the b2c_payment module"""
-        hashed_token = get_hashed_token()
-        token = frappe.db.get_value(
-            "Daraja Access Tokens",
-            {"token_fetch_time": TOKEN_ACCESS_TIME},
-            ["name"],
-        )
 
-        self.assertEqual(hashed_token, token)
+AUTHENTICATION_RESPONSE = {"access_token": "987654321", "expires_in": "3599"}
 
-    @patch.object(mpesa_b2c_payment.requests, "get")
-    def test_get_access_tokens(self, mock_response: MagicMock) -> None:
-        """Tests the get_access_tokens() function from the b2c_payment module"""
-        mock_response.return_value.status_code = 200
-        mock_response.return_value.text = {
-            "access_token": "987654321",
-            "expires_in": "3599",
-        }
 
-        token, status_code = mpesa_b2c_payment.get_access_tokens(
-            "123456789", "secret", "https://example.com/authorise"
+@patch.object(mpesa_connector.time, "sleep")
+@patch.object(mpesa_connector, "save_access_token")
+@patch.object(mpesa_connector._SESSION, "request")
+class TestAuthentication(FrappeTestCase):
+    """Tests for MpesaB2CConnector.authenticate()"""
+
+    def tearDown(self) -> None:
+        mpesa_connector._TOKEN_CACHE.clear()
+
+    def test_successful_authentication(
+        self, mock_request: MagicMock, mock_save: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that a fetched token is returned, cached, and saved"""
+        mock_request.return_value = get_response(200, AUTHENTICATION_RESPONSE)
+
+        token = MpesaB2CConnector(app_key="key", app_secret="secret").authenticate(
+            TEST_SETTING
+        )
+
+        self.assertEqual(token["access_token"], "987654321")
+        self.assertGreater(token["expires_in"], token["fetched_time"])
+        self.assertEqual(mpesa_connector._get_cached_token(TEST_SETTING), "987654321")
+
+        method, url = mock_request.call_args.args
+        self.assertEqual(method, "GET")
+        self.assertEqual(
+            url,
+            "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials",
+        )
+        self.assertEqual(
+            mock_request.call_args.kwargs["timeout"],
+            mpesa_connector.AUTHENTICATION_TIMEOUT,
         )
-        self.assertIsInstance(token, dict)
+        self.assertEqual(mock_save.call_args.kwargs["token"], "987654321")
+        self.assertEqual(mock_save.call_args.kwargs["associated_setting"], TEST_SETTING)
+
+    def test_authentication_is_retried(
+        self, mock_request: MagicMock, mock_save: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that the idempotent token request is retried on any transient error"""
+        mock_request.side_effect = [
+            requests.ReadTimeout(),
+            get_response(500),
+            get_response(200, AUTHENTICATION_RESPONSE),
+        ]
+
+        token = MpesaB2CConnector().authenticate(TEST_SETTING)
+
         self.assertEqual(token["access_token"], "987654321")
-        self.assertEqual(token["expires_in"], "3599")
-        self.assertEqual(status_code, 200)
-
-    @patch.object(mpesa_b2c_payment.requests, "get", side_effect=requests.HTTPError)
-    def test_get_access_tokens_error_response(self, mock_request: MagicMock) -> None:
-        """
-        Tests instances the get_access_tokens() function from the b2c_payment receives an error response
-        """
-        response = None
-
-        with self.assertRaises(requests.HTTPError):
-            response = get_access_tokens(
-                "123456789", "secret", "https://example.com/authorise"
+        self.assertEqual(mock_request.call_count, 3)
+
+    def test_authentication_error_response(
+        self, mock_request: MagicMock, mock_save: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that rejected credentials raise without saving a token"""
+        mock_request.return_value = get_response(400, {"errorMessage": "Invalid"})
+
+        with self.assertRaises(frappe.ValidationError):
+            MpesaB2CConnector().authenticate(TEST_SETTING)
+
+        mock_save.assert_not_called()
+        self.assertIsNone(mpesa_connector._get_cached_token(TEST_SETTING))
+
+    def test_authentication_connection_error(
+        self, mock_request: MagicMock, mock_save: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that failing to reach Daraja raises once all attempts failed"""
+        mock_request.side_effect = requests.ConnectionError
+
+        with self.assertRaises(requests.ConnectionError):
+            MpesaB2CConnector(max_retries=2).authenticate(TEST_SETTING)
+
+        self.assertEqual(mock_request.call_count, 2)
+        mock_save.assert_not_called()
+
+
+@patch.object(MpesaB2CConnector, "authenticate")
+@patch.object(mpesa_connector, "get_valid_access_token")
+class TestAccessTokenCache(FrappeTestCase):
+    """Tests for the resolution and caching of access tokens"""
+
+    def tearDown(self) -> None:
+        mpesa_connector._TOKEN_CACHE.clear()
+
+    def test_cached_token_is_used(
+        self, mock_get_token: MagicMock, mock_authenticate: MagicMock
+    ) -> None:
+        """Tests that a valid cached token is used without querying the database"""
+        mpesa_connector._cache_token(
+            TEST_SETTING,
+            "cached",
+            datetime.datetime.now() + datetime.timedelta(hours=1),
+        )
+
+        token = MpesaB2CConnector()._get_access_token(get_b2c_request_data("cached"))
+
+        self.assertEqual(token, "cached")
+        mock_get_token.assert_not_called()
+        mock_authenticate.assert_not_called()
+
+    def test_expiring_cached_token_is_ignored(
+        self, mock_get_token: MagicMock, mock_authenticate: MagicMock
+    ) -> None:
+        """Tests that a cached token within the expiry margin is not used"""
+        mpesa_connector._cache_token(
+            TEST_SETTING,
+            "expiring",
+            datetime.datetime.now() + datetime.timedelta(seconds=5),
+        )
+        mock_get_token.return_value = None
+        mock_authenticate.return_value = {"access_token": "fresh"}
+
+        token = MpesaB2CConnector()._get_access_token(get_b2c_request_data("fresh"))
+
+        self.assertEqual(token, "fresh")
+        mock_authenticate.assert_called_once_with(
+            TEST_SETTING, app_key="consumer-key", app_secret="consumer-secret"
+        )
+
+    def test_stored_token_is_cached(
+        self, mock_get_token: MagicMock, mock_authenticate: MagicMock
+    ) -> None:
+        """Tests that a token from the database is cached for subsequent requests"""
+        mock_get_token.return_value = frappe._dict(
+            access_token="stored",
+            expiry_time=datetime.datetime.now() + datetime.timedelta(hours=1),
+        )
+
+        for _ in range(2):
+            token = MpesaB2CConnector()._get_access_token(
+                get_b2c_request_data("stored")
             )
 
-        self.assertIsNone(response)
+            self.assertEqual(token, "stored")
 
-    @patch.object(
-        mpesa_b2c_payment.requests,
-        "get",
-        side_effect=requests.exceptions.ConnectionError,
-    )
-    def test_get_access_tokens_connection_error(self, mock_request: MagicMock) -> None:
-        """
-        Tests instances the get_access_tokens() function from the mpesa_b2c_payment fails to connect
-        """
-        response = None
-
-        with self.assertRaises(requests.exceptions.ConnectionError):
-            response = get_access_tokens(
-                "123456789", "secret", "https://256.256.256.256/welcome"
+        mock_get_token.assert_called_once_with(TEST_SETTING)
+        mock_authenticate.assert_not_called()
+
+    @patch.object(base_classes, "enqueue_b2c_error_log")
+    @patch.object(mpesa_connector, "enqueue_access_token_expiry")
+    @patch.object(mpesa_connector._SESSION, "request")
+    @patch.object(mpesa_connector, "create_request_log")
+    def test_rejected_token_is_invalidated(
+        self,
+        mock_request_log: MagicMock,
+        mock_request: MagicMock,
+        mock_enqueue: MagicMock,
+        mock_error_log: MagicMock,
+        mock_get_token: MagicMock,
+        mock_authenticate: MagicMock,
+    ) -> None:
+        """Tests that a 401 drops the token from the cache and expires it in the database"""
+        mpesa_connector._CIRCUIT.update(fails=0, open_until=0.0)
+        mpesa_connector._cache_token(
+            TEST_SETTING,
+            "revoked",
+            datetime.datetime.now() + datetime.timedelta(hours=1),
+        )
+        mock_request.return_value = get_response(
+            401, {"errorMessage": "Invalid Access Token"}
+        )
+
+        with self.assertRaises(frappe.DataError):
+            MpesaB2CConnector().make_b2c_payment_request(
+                get_b2c_request_data("unauthorised")
             )
 
-        self.assertIsNone(response)
+        self.assertIsNone(mpesa_connector._get_cached_token(TEST_SETTING))
+        mock_enqueue.assert_called_once_with(TEST_SETTING)
 
-    def test_save_access_token_to_database(self) -> None:
-        """Tests saving access token to database"""
-        response = json.dumps(
-            {
-                "access_token": "987abc321xyz",
-                "expires_in": "600",
-            }
+
+class TestAccessTokenHelpers(FrappeTestCase):
+    """Tests for the access token database helpers"""
+
+    def tearDown(self) -> None:
+        frappe.db.rollback()
+
+    def test_get_valid_access_token(self) -> None:
+        """Tests that the setting's latest unexpired token is returned decrypted"""
+        now = datetime.datetime.now()
+        create_setting_access_token(
+            "expired",
+            now - datetime.timedelta(hours=2),
+            now - datetime.timedelta(hours=1),
+        )
+        create_setting_access_token(
+            "older",
+            now - datetime.timedelta(minutes=30),
+            now + datetime.timedelta(minutes=30),
         )
-        saved_token = save_access_token_to_database(response)
+        create_setting_access_token("latest", now, now + datetime.timedelta(hours=1))
 
-        hashed_token = frappe.db.sql(
-            """
-            SELECT name
-            FROM `tabDaraja Access Tokens`
-            ORDER BY creation DESC
-            LIMIT 1
-            """,
-            as_dict=True,
-        )[0]
-        token = get_decrypted_password(
-            "Daraja Access Tokens", hashed_token.name, "access_token"
+        token = helpers.get_valid_access_token(TEST_SETTING)
+
+        self.assertEqual(token.access_token, "latest")
+        self.assertEqual(token.expiry_time, now + datetime.timedelta(hours=1))
+
+    def test_get_valid_access_token_none_stored(self) -> None:
+        """Tests that None is returned for a setting without unexpired tokens"""
+        self.assertIsNone(helpers.get_valid_access_token("Unknown Mpesa Setting"))
+
+    @patch.object(helpers, "_enqueue")
+    def test_enqueue_access_token_expiry(self, mock_enqueue: MagicMock) -> None:
+        """Tests that the expiry of a rejected token runs in a background job"""
+        helpers.enqueue_access_token_expiry(TEST_SETTING)
+
+        mock_enqueue.assert_called_once_with(
+            "navari_mpesa_b2c.mpesa_b2c.utils.helpers.expire_access_tokens",
+            queue="short",
+            associated_setting=TEST_SETTING,
         )
 
-        self.assertEqual(saved_token, "987abc321xyz")
-        self.assertEqual(token, "987abc321xyz")
+    def test_expire_access_tokens(self) -> None:
+        """Tests that a setting's stored tokens can no longer be used once expired"""
+        now = datetime.datetime.now()
+        create_setting_access_token("revoked", now, now + datetime.timedelta(hours=1))
+
+        helpers.expire_access_tokens(TEST_SETTING)
+
+        self.assertIsNone(helpers.get_valid_access_token(TEST_SETTING))
+
+    def test_delete_expired_access_tokens(self) -> None:
+        """Tests that expired tokens are deleted together with their stored passwords"""
+        now = datetime.datetime.now()
+        expired_token = create_setting_access_token(
+            "expired",
+            now - datetime.timedelta(hours=2),
+            now - datetime.timedelta(hours=1),
+        )
+        valid_token = create_setting_access_token(
+            "valid", now, now + datetime.timedelta(hours=1)
+        )
+
+        helpers.delete_expired_access_tokens()
+
+        self.assertFalse(frappe.db.exists("Daraja Access Tokens", expired_token))
+        self.assertTrue(frappe.db.exists("Daraja Access Tokens", valid_token))
+
+        auth = Table("__Auth")
+        stored_passwords = (
+            frappe.qb.from_(auth)
+            .select(auth.name)
+            .where(auth.doctype == "Daraja Access Tokens")
+            .where(auth.name.isin([str(expired_token), str(valid_token)]))
+            .run(pluck=True)
+        )
+        self.assertListEqual(stored_passwords, [str(valid_token)])
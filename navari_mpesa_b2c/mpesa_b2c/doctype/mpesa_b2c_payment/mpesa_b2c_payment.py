@@ -5,7 +5,11 @@
 import frappe
 from frappe.model.document import Document
 
-from ...scripts.server.mpesa_connector import MpesaB2CConnector
+from ...scripts.server.mpesa_connector import (
+    DEFAULT_BASE_DELAY,
+    DEFAULT_MAX_RETRIES,
+    get_connector,
+)
 from ...utils.definitions import B2CRequestDefinition
 from .. import app_logger
 from ..custom_exceptions import InformationMismatchError
@@ -53,14 +57,26 @@ class MPesaB2CPayment(Document):
         )
 
         if setting:
-            connector = MpesaB2CConnector()
+            connector = get_connector(
+                max_retries=(
+                    DEFAULT_MAX_RETRIES
+                    if setting.custom_b2c_max_retries is None
+                    else setting.custom_b2c_max_retries
+                ),
+                base_delay=(
+                    DEFAULT_BASE_DELAY
+                    if setting.custom_b2c_base_delay is None
+                    else setting.custom_b2c_base_delay
+                ),
+            )
+            consumer_secret = setting.get_password("consumer_secret")
 
-            for item in self.items:
-                connector.make_b2c_payment_request(
+            results = connector.bulk_b2c(
+                [
                     B2CRequestDefinition(
                         Setting=setting.name,
                         ConsumerKey=setting.consumer_key,
-                        ConsumerSecret=setting.get_password("consumer_secret"),
+                        ConsumerSecret=consumer_secret,
                         OriginatorConversationID=item.originator_conversation_id,
                         InitiatorName=setting.initiator_name,
                         SecurityCredential=setting.security_credential,
@@ -71,8 +87,28 @@ class MPesaB2CPayment(Document):
                         Remarks=self.remarks,
                         Occassion=self.occassion,
                     )
+                    for item in self.items
+                ]
+            )
+
+            # Items are reported individually as some of them may have been paid out
+            failed_items = [
+                f"Row {item.idx}: {result.error}"
+                for item, result in zip(self.items, results)
+                if result.error
+            ]
+
+            if len(failed_items) < len(results):
+                frappe.msgprint(
+                    "Payment Request Initiated.",
+                    title="Payment Request",
+                    indicator="green",
                 )
 
-            frappe.msgprint(
-                "Payment Request Initiated.", title="Payment Request", indicator="green"
-            )
+            if failed_items:
+                frappe.msgprint(
+                    "The following Payment Requests failed:<br>"
+                    + "<br>".join(failed_items),
+                    title="Payment Request",
+                    indicator="red",
+                )
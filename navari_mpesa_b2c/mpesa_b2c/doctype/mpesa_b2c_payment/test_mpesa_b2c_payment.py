@@ -2,33 +2,39 @@
 # See license.txt
 
 
-import datetime
-import random
-import string
+import time
 from unittest.mock import MagicMock, patch
 
-import frappe
+import httpx
+import orjson
 import pymysql
 import requests
-from frappe.model.document import Document
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ...scripts.server import base_classes, mpesa_connector
+from ...scripts.server.mpesa_connector import MpesaB2CConnector
+from ...scripts.setup import uninstall
+from ...utils import helpers
+from ...utils.definitions import B2CRequestDefinition, B2CResult
 from ..custom_exceptions import (
+    DarajaCircuitOpenError,
     IncorrectStatusError,
     InformationMismatchError,
     InsufficientPaymentAmountError,
     InvalidReceiverMobileNumberError,
 )
 from ..mpesa_b2c_payment import mpesa_b2c_payment
-from ..mpesa_b2c_payment.mpesa_b2c_payment import (
-    extract_transaction_values,
-    get_result_details,
-    handle_successful_result_response,
-    sanitise_phone_number,
-    send_payload,
-    update_doctype_single_values,
-    validate_receiver_mobile_number,
-)
+
+PAYMENT_REQUEST_URL = "https://sandbox.safaricom.co.ke/mpesa/b2c/v3/paymentrequest"
+SUCCESSFUL_PAYMENT_RESPONSE = {
+    "ConversationID": "AG_20191219_00005797af5d7d75f652",
+    "OriginatorConversationID": "16740-34861180-1",
+    "ResponseCode": "0",
+    "ResponseDescription": "Accept the service request successfully.",
+}
+ASYNC_CLIENT = httpx.AsyncClient
 
 SUCCESSFUL_TEST_RESULTS = {
     "Result": {
@@ -330,236 +336,765 @@ class TestMPesaB2CPayment(FrappeTestCase):
                 }
             ).insert()
 
-    def test_extract_transaction_values(self) -> None:
-        """Tests extract_transaction_values() from the mpesa_b2c_payment module"""
-        transaction_values = extract_transaction_values(
-            SUCCESSFUL_TEST_RESULTS["Result"]["ResultParameters"]["ResultParameter"],
-            SUCCESSFUL_TEST_RESULTS["Result"]["TransactionID"],
-        )
+    def test_on_submit_reports_failed_items(self) -> None:
+        """Tests that a partly failed batch is reported per item instead of raising"""
+        payment = frappe.new_doc("MPesa B2C Payment")
+        payment.commandid = "BusinessPayment"
+        for originator_conversation_id in ("paid", "failed"):
+            payment.append(
+                "items",
+                {
+                    "originator_conversation_id": originator_conversation_id,
+                    "partyb": "254708374149",
+                    "amount": 10,
+                },
+            )
 
-        self.assertIsInstance(transaction_values, dict)
-        self.assertEqual(len(transaction_values), 8)
-        self.assertEqual(
-            transaction_values["recipient_is_registered_customer"],
-            SUCCESSFUL_TEST_RESULTS["Result"]["ResultParameters"]["ResultParameter"][2][
-                "Value"
-            ],
+        with (
+            patch.object(mpesa_b2c_payment.frappe, "get_doc"),
+            patch.object(mpesa_b2c_payment, "get_connector") as mock_get_connector,
+            patch.object(mpesa_b2c_payment.frappe, "msgprint") as mock_msgprint,
+        ):
+            mock_get_connector.return_value.bulk_b2c.return_value = [
+                B2CResult("paid", response=SUCCESSFUL_PAYMENT_RESPONSE),
+                B2CResult("failed", error=Exception("Bad Request")),
+            ]
+
+            payment.on_submit()
+
+        self.assertEqual(mock_msgprint.call_count, 2)
+        self.assertEqual(mock_msgprint.call_args_list[0].kwargs["indicator"], "green")
+
+        failure_message, *_ = mock_msgprint.call_args_list[1].args
+        self.assertEqual(mock_msgprint.call_args_list[1].kwargs["indicator"], "red")
+        self.assertIn("Row 2: Bad Request", failure_message)
+        self.assertNotIn("Row 1", failure_message)
+
+
+def get_b2c_request_data(originator_conversation_id: str) -> B2CRequestDefinition:
+    """Creates B2C request data for testing"""
+    return B2CRequestDefinition(
+        Setting="Test Mpesa Setting",
+        ConsumerKey="consumer-key",
+        ConsumerSecret="consumer-secret",
+        OriginatorConversationID=originator_conversation_id,
+        InitiatorName="testapi",
+        SecurityCredential="security-credential",
+        CommandID="BusinessPayment",
+        Amount="10",
+        PartyA="600000",
+        PartyB="254708374149",
+        Remarks="test remarks",
+        Occassion="Testing",
+    )
+
+
+def prepare_b2c_payment_request(
+    request_data: B2CRequestDefinition, access_token: str | None = None
+) -> tuple[str, str, dict[str, str], str]:
+    """Stands in for MpesaB2CConnector._prepare_b2c_payment_request() without touching the DB"""
+    if request_data.OriginatorConversationID == "duplicate":
+        raise frappe.DuplicateEntryError
+
+    return (
+        f"{PAYMENT_REQUEST_URL}?id={request_data.OriginatorConversationID}",
+        request_data.to_json(),
+        {
+            "Authorization": f"Bearer {access_token or 'token'}",
+            "Content-Type": "application/json",
+        },
+        request_data.OriginatorConversationID,
+    )
+
+
+def daraja_handler(request: httpx.Request) -> httpx.Response:
+    """Mock Daraja endpoint failing the requests whose id starts with 'failing'
+    or 'unauthorised'"""
+    if request.url.params["id"].startswith("failing"):
+        return httpx.Response(400, json={"errorMessage": "Bad Request"})
+
+    if request.url.params["id"].startswith("unauthorised"):
+        return httpx.Response(401, json={"errorMessage": "Invalid Access Token"})
+
+    return httpx.Response(200, json=SUCCESSFUL_PAYMENT_RESPONSE | {"Extra": "field"})
+
+
+def mock_async_client(**kwargs) -> httpx.AsyncClient:
+    return ASYNC_CLIENT(transport=httpx.MockTransport(daraja_handler), **kwargs)
+
+
+@patch.object(MpesaB2CConnector, "_get_access_token", return_value="token")
+@patch.object(
+    MpesaB2CConnector,
+    "_prepare_b2c_payment_request",
+    side_effect=prepare_b2c_payment_request,
+)
+@patch.object(mpesa_connector.httpx, "AsyncClient", side_effect=mock_async_client)
+@patch.object(mpesa_connector, "enqueue_b2c_error_log")
+class TestMpesaB2CConnectorBulkRequests(FrappeTestCase):
+    """Tests for MpesaB2CConnector.bulk_b2c()"""
+
+    def setUp(self) -> None:
+        mpesa_connector._CIRCUIT.update(fails=0, open_until=0.0)
+
+    def test_bulk_b2c_mixed_batch(
+        self,
+        mock_enqueue: MagicMock,
+        mock_client: MagicMock,
+        mock_prepare: MagicMock,
+        mock_get_token: MagicMock,
+    ) -> None:
+        """Tests that failures in a batch are logged and returned without affecting the rest"""
+        results = MpesaB2CConnector().bulk_b2c(
+            [
+                get_b2c_request_data("paid"),
+                get_b2c_request_data("failing"),
+                get_b2c_request_data("duplicate"),
+                get_b2c_request_data("paid-too"),
+            ]
         )
-        self.assertEqual(
-            transaction_values["receiver_public_name"],
-            SUCCESSFUL_TEST_RESULTS["Result"]["ResultParameters"]["ResultParameter"][4][
-                "Value"
-            ],
+
+        self.assertEqual(len(results), 4)
+
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[0].integration_request, "paid")
+        self.assertDictEqual(results[0].response, SUCCESSFUL_PAYMENT_RESPONSE)
+        self.assertIsNone(results[3].error)
+
+        self.assertIsInstance(results[1].error, httpx.HTTPStatusError)
+        self.assertEqual(results[1].integration_request, "failing")
+
+        self.assertIsInstance(results[2].error, frappe.DuplicateEntryError)
+        self.assertIsNone(results[2].integration_request)
+
+        self.assertEqual(mock_enqueue.call_count, 2)
+        mock_enqueue.assert_any_call(results[1].error, "failing")
+        mock_enqueue.assert_any_call(results[2].error, None)
+
+    def test_bulk_b2c_authenticates_once(
+        self,
+        mock_enqueue: MagicMock,
+        mock_client: MagicMock,
+        mock_prepare: MagicMock,
+        mock_get_token: MagicMock,
+    ) -> None:
+        """Tests that the access token is resolved once for the whole batch"""
+        requests_list = [get_b2c_request_data(f"paid-{index}") for index in range(3)]
+
+        results = MpesaB2CConnector().bulk_b2c(requests_list)
+
+        self.assertTrue(all(result.error is None for result in results))
+        mock_get_token.assert_called_once_with(requests_list[0])
+
+        for request_data in requests_list:
+            mock_prepare.assert_any_call(request_data, "token")
+
+    def test_bulk_b2c_authentication_failure(
+        self,
+        mock_enqueue: MagicMock,
+        mock_client: MagicMock,
+        mock_prepare: MagicMock,
+        mock_get_token: MagicMock,
+    ) -> None:
+        """Tests that failing to get a token fails the batch before any request is sent"""
+        mock_get_token.side_effect = frappe.ValidationError
+
+        with self.assertRaises(frappe.ValidationError):
+            MpesaB2CConnector().bulk_b2c(
+                [get_b2c_request_data("paid"), get_b2c_request_data("paid-too")]
+            )
+
+        mock_get_token.assert_called_once()
+        mock_prepare.assert_not_called()
+        mock_client.assert_not_called()
+
+    @patch.object(mpesa_connector, "_invalidate_cached_token")
+    def test_bulk_b2c_rejected_token(
+        self,
+        mock_invalidate: MagicMock,
+        mock_enqueue: MagicMock,
+        mock_client: MagicMock,
+        mock_prepare: MagicMock,
+        mock_get_token: MagicMock,
+    ) -> None:
+        """Tests that a token rejected by Daraja is invalidated once per batch"""
+        results = MpesaB2CConnector().bulk_b2c(
+            [
+                get_b2c_request_data("unauthorised"),
+                get_b2c_request_data("unauthorised-too"),
+            ]
         )
-        transaction_completed_datetime = datetime.datetime.strptime(
-            transaction_values["transaction_completed_datetime"][:-4],
-            "%Y-%m-%d %H:%M:%S",
-        ).strftime("%d.%m.%Y %H:%M:%S")
-        self.assertEqual(
-            transaction_completed_datetime,
-            SUCCESSFUL_TEST_RESULTS["Result"]["ResultParameters"]["ResultParameter"][5][
-                "Value"
-            ],
+
+        self.assertTrue(all(result.error for result in results))
+        mock_invalidate.assert_called_once_with("Test Mpesa Setting")
+
+
+def get_response(
+    status_code: int,
+    body: dict | None = None,
+    headers: dict[str, str] | None = None,
+) -> requests.Response:
+    """Builds a Daraja response as returned by requests"""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = orjson.dumps(body or {})
+    response.headers.update(headers or {})
+    response.url = PAYMENT_REQUEST_URL
+
+    return response
+
+
+@patch.object(mpesa_connector.time, "sleep")
+@patch.object(mpesa_connector._SESSION, "request")
+class TestRequestWithBackoff(FrappeTestCase):
+    """Tests for the retry policy of requests sent to Daraja"""
+
+    def test_transient_errors_are_retried(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that retriable status codes are retried until a request succeeds"""
+        mock_request.side_effect = [
+            get_response(503),
+            get_response(500),
+            get_response(200),
+        ]
+
+        response = mpesa_connector._request_with_backoff("GET", PAYMENT_REQUEST_URL)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_client_errors_are_not_retried(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that a non retriable status code is raised immediately"""
+        for status_code in (400, 401, 404):
+            mock_request.reset_mock()
+            mock_request.return_value = get_response(status_code)
+
+            with self.assertRaises(requests.HTTPError):
+                mpesa_connector._request_with_backoff("GET", PAYMENT_REQUEST_URL)
+
+            self.assertEqual(mock_request.call_count, 1)
+
+        mock_sleep.assert_not_called()
+
+    def test_retries_are_exhausted(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that the last error is raised once all attempts failed"""
+        mock_request.side_effect = requests.ConnectionError
+
+        with self.assertRaises(requests.ConnectionError):
+            mpesa_connector._request_with_backoff(
+                "GET", PAYMENT_REQUEST_URL, max_retries=4
+            )
+
+        self.assertEqual(mock_request.call_count, 4)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    def test_at_least_one_attempt_is_made(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that a request is sent once even when no retries are configured"""
+        mock_request.return_value = get_response(200)
+
+        response = mpesa_connector._request_with_backoff(
+            "GET", PAYMENT_REQUEST_URL, max_retries=0
         )
 
-    def test_get_result_details_function(self) -> None:
-        """Tests the get_result_details() function from the mpesa_b2c_payment module"""
-        output = get_result_details(SUCCESSFUL_TEST_RESULTS["Result"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 1)
 
-        self.assertIsInstance(output, tuple)
-        self.assertEqual(len(output), 5)
-        self.assertEqual(
-            output[0], SUCCESSFUL_TEST_RESULTS["Result"]["OriginatorConversationID"]
+    @patch.object(mpesa_connector.time, "monotonic", side_effect=[0.0, 9.5])
+    def test_retries_stop_at_total_timeout(
+        self, mock_monotonic: MagicMock, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that no attempt is started once the total timeout would be exceeded"""
+        mock_request.side_effect = requests.ReadTimeout
+
+        with self.assertRaises(requests.ReadTimeout):
+            mpesa_connector._request_with_backoff(
+                "GET", PAYMENT_REQUEST_URL, total_timeout=10.0
+            )
+
+        self.assertEqual(mock_request.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    def test_retry_after_is_honoured_up_to_max_delay(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that Retry-After replaces the computed delay but is capped"""
+        mock_request.side_effect = [
+            get_response(503, headers={"Retry-After": "2"}),
+            get_response(429, headers={"Retry-After": "3600"}),
+            get_response(200),
+        ]
+
+        mpesa_connector._request_with_backoff(
+            "GET", PAYMENT_REQUEST_URL, max_delay=30.0
         )
-        self.assertEqual(output[4], SUCCESSFUL_TEST_RESULTS["Result"]["TransactionID"])
 
-    @patch.object(mpesa_b2c_payment.requests, "post")
-    def test_send_payload(self, mock_response: MagicMock) -> None:
-        """Tests the send_payload() function from the b2c_payment module"""
-        mock_response.return_value.status_code = 200
-        mock_response.return_value.text = {"message": "Success"}
+        self.assertListEqual(
+            [call.args[0] for call in mock_sleep.call_args_list], [2, 30.0]
+        )
 
-        response, status_code = send_payload(
-            "123456789", "secret", "https://example.com/payment"
+    @patch.object(mpesa_connector.random, "uniform", return_value=0.0)
+    def test_invalid_retry_after_is_ignored(
+        self, mock_uniform: MagicMock, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that an unparsable Retry-After falls back to the exponential delay"""
+        mock_request.side_effect = [
+            get_response(503, headers={"Retry-After": "soon"}),
+            get_response(200),
+        ]
+
+        mpesa_connector._request_with_backoff(
+            "GET", PAYMENT_REQUEST_URL, base_delay=1.0
         )
-        self.assertIsInstance(response, dict)
-        self.assertEqual(response["message"], "Success")
-        self.assertEqual(status_code, 200)
 
-    @patch.object(mpesa_b2c_payment.requests, "post", side_effect=requests.HTTPError)
-    def test_send_payload_error_response(self, mock_response: MagicMock) -> None:
-        """Tests instances the send_payload() from the b2c_payment module receives an error response"""
-        response, status_code = None, None
+        mock_sleep.assert_called_once_with(1.0)
+
+    def test_non_idempotent_requests_are_not_retried_once_sent(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that payment requests which may have reached Daraja are not repeated"""
+        for error in (requests.ReadTimeout(), requests.ConnectionError()):
+            mock_request.reset_mock()
+            mock_request.side_effect = error
+
+            with self.assertRaises(type(error)):
+                mpesa_connector._request_with_backoff(
+                    "POST", PAYMENT_REQUEST_URL, idempotent=False
+                )
+
+            self.assertEqual(mock_request.call_count, 1)
+
+        mock_request.reset_mock()
+        mock_request.side_effect = None
+        mock_request.return_value = get_response(500)
 
         with self.assertRaises(requests.HTTPError):
-            response, status_code = send_payload(
-                "123456789", "secret", "https://example.com/payment"
+            mpesa_connector._request_with_backoff(
+                "POST", PAYMENT_REQUEST_URL, idempotent=False
             )
 
-        self.assertIsNone(response)
-        self.assertIsNone(status_code)
+        self.assertEqual(mock_request.call_count, 1)
+        mock_sleep.assert_not_called()
 
+    def test_non_idempotent_requests_are_retried_when_unprocessed(
+        self, mock_request: MagicMock, mock_sleep: MagicMock
+    ) -> None:
+        """Tests that payment requests Daraja never processed are retried"""
+        mock_request.side_effect = [
+            requests.ConnectTimeout(),
+            get_response(429),
+            get_response(200),
+        ]
+
+        response = mpesa_connector._request_with_backoff(
+            "POST", PAYMENT_REQUEST_URL, idempotent=False
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 3)
+
+
+@patch.object(helpers.frappe, "db")
+class TestIntegrationRequestHelpers(FrappeTestCase):
+    """Tests for the helpers recording the outcome of Integration Requests"""
+
+    def test_update_integration_request(self, mock_db: MagicMock) -> None:
+        """Tests that the Integration Request is updated with a single blind write"""
+        helpers.update_integration_request(
+            "integration-request",
+            "Failed",
+            output={"ResultCode": 2001},
+            error="The initiator information is invalid.",
+        )
+
+        mock_db.set_value.assert_called_once_with(
+            "Integration Request",
+            "integration-request",
+            {
+                "status": "Failed",
+                "error": "The initiator information is invalid.",
+                "output": '{"ResultCode":2001}',
+            },
+            update_modified=True,
+        )
+        mock_db.get_value.assert_not_called()
+        mock_db.sql.assert_not_called()
+
+    def test_update_integration_request_str_output(self, mock_db: MagicMock) -> None:
+        """Tests that a str output is stored as is rather than as a JSON string"""
+        helpers.update_integration_request(
+            "integration-request", "Completed", output="Accepted"
+        )
+
+        _, _, values = mock_db.set_value.call_args.args
+        self.assertEqual(values["output"], "Accepted")
+
+    def test_update_integration_request_without_output(
+        self, mock_db: MagicMock
+    ) -> None:
+        """Tests that a missing output is stored as None"""
+        helpers.update_integration_request("integration-request", "Failed", error="Bad")
+
+        _, _, values = mock_db.set_value.call_args.args
+        self.assertIsNone(values["output"])
+
+
+class TestErrorLogging(FrappeTestCase):
+    """Tests for the background logging of failed Daraja requests"""
+
+    @patch.object(helpers, "_enqueue")
+    def test_enqueue_b2c_error_log(self, mock_enqueue: MagicMock) -> None:
+        """Tests that the error is logged in a background job"""
+        helpers.enqueue_b2c_error_log(Exception("Bad Request"), "integration-request")
+
+        mock_enqueue.assert_called_once_with(
+            "navari_mpesa_b2c.mpesa_b2c.utils.helpers._log_b2c_error",
+            queue="short",
+            title="HTTPError",
+            message="Bad Request",
+            integration_request="integration-request",
+        )
+
+    @patch.object(helpers, "update_integration_request")
+    @patch.object(helpers, "_log_error")
+    def test_log_b2c_error(
+        self, mock_log_error: MagicMock, mock_update: MagicMock
+    ) -> None:
+        """Tests that the error is logged and its Integration Request marked as Failed"""
+        helpers._log_b2c_error("HTTPError", "Bad Request", "integration-request")
+
+        mock_log_error.assert_called_once_with(title="HTTPError", message="Bad Request")
+        mock_update.assert_called_once_with(
+            "integration-request", status="Failed", error="Bad Request"
+        )
+
+    @patch.object(helpers, "update_integration_request")
+    @patch.object(helpers, "_log_error")
+    def test_log_b2c_error_without_integration_request(
+        self, mock_log_error: MagicMock, mock_update: MagicMock
+    ) -> None:
+        """Tests logging an error raised before the Integration Request was created"""
+        helpers._log_b2c_error("HTTPError", "Duplicate entry", None)
+
+        mock_log_error.assert_called_once()
+        mock_update.assert_not_called()
+
+
+class TestCircuitBreaker(FrappeTestCase):
+    """Tests for the circuit breaker short-circuiting requests during Daraja outages"""
+
+    def setUp(self) -> None:
+        mpesa_connector._CIRCUIT.update(fails=0, open_until=0.0)
+        mpesa_connector._TOKEN_CACHE.clear()
+
+    def tearDown(self) -> None:
+        mpesa_connector._CIRCUIT.update(fails=0, open_until=0.0)
+        mpesa_connector._TOKEN_CACHE.clear()
+
+    def test_circuit_opens_after_repeated_failures(self) -> None:
+        """Tests that the circuit opens once the failure threshold is reached"""
+        for _ in range(mpesa_connector.CIRCUIT_FAILURE_THRESHOLD - 1):
+            mpesa_connector._record_failure(503)
+
+        mpesa_connector._check_circuit()
+
+        mpesa_connector._record_failure()
+
+        with self.assertRaises(DarajaCircuitOpenError):
+            mpesa_connector._check_circuit()
+
+    def test_client_errors_do_not_open_circuit(self) -> None:
+        """Tests that non transient error responses are not counted"""
+        for _ in range(mpesa_connector.CIRCUIT_FAILURE_THRESHOLD):
+            mpesa_connector._record_failure(400)
+
+        mpesa_connector._check_circuit()
+
+    def test_success_resets_failures(self) -> None:
+        """Tests that a successful request resets the consecutive failure count"""
+        for _ in range(mpesa_connector.CIRCUIT_FAILURE_THRESHOLD - 1):
+            mpesa_connector._record_failure()
+
+        mpesa_connector._record_success()
+        mpesa_connector._record_failure()
+
+        mpesa_connector._check_circuit()
+
+    def test_circuit_closes_after_open_duration(self) -> None:
+        """Tests that requests are let through again once the circuit expired"""
+        mpesa_connector._CIRCUIT["open_until"] = time.time() - 1
+
+        mpesa_connector._check_circuit()
+
+    @patch.object(mpesa_connector._SESSION, "request")
+    def test_open_circuit_short_circuits_requests(
+        self, mock_request: MagicMock
+    ) -> None:
+        """Tests that no request is sent to Daraja while the circuit is open"""
+        mpesa_connector._CIRCUIT["open_until"] = time.time() + 60
+
+        with self.assertRaises(DarajaCircuitOpenError):
+            MpesaB2CConnector().make_b2c_payment_request(get_b2c_request_data("paid"))
+
+        with self.assertRaises(DarajaCircuitOpenError):
+            MpesaB2CConnector().bulk_b2c([get_b2c_request_data("paid")])
+
+        with self.assertRaises(DarajaCircuitOpenError):
+            MpesaB2CConnector().authenticate("Test Mpesa Setting")
+
+        mock_request.assert_not_called()
+
+    @patch.object(mpesa_connector, "get_valid_access_token", return_value=None)
+    @patch.object(mpesa_connector.time, "sleep")
     @patch.object(
-        mpesa_b2c_payment.requests,
-        "post",
-        side_effect=requests.exceptions.ConnectionError,
+        mpesa_connector._SESSION, "request", side_effect=requests.ConnectTimeout
     )
-    def test_send_payload_error_connection_failure(
-        self, mock_response: MagicMock
+    def test_authentication_failures_open_circuit(
+        self,
+        mock_request: MagicMock,
+        mock_sleep: MagicMock,
+        mock_get_valid_access_token: MagicMock,
     ) -> None:
-        """Tests instances the send_payload() from the b2c_payment fails due to a lack of connection"""
-        response = None
+        """Tests that failing token requests open the circuit"""
+        connector = MpesaB2CConnector()
+        requests_list = [get_b2c_request_data(f"paid-{i}") for i in range(3)]
 
-        with self.assertRaises(requests.exceptions.ConnectionError):
-            response = send_payload(
-                "123456789", "secret", "https://example.com/payment"
-            )
+        for _ in range(mpesa_connector.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(requests.ConnectTimeout):
+                connector.bulk_b2c(requests_list)
+
+        self.assertEqual(
+            mock_request.call_count,
+            mpesa_connector.CIRCUIT_FAILURE_THRESHOLD * connector.max_retries,
+        )
+
+        mock_request.reset_mock()
+
+        with self.assertRaises(DarajaCircuitOpenError):
+            connector.bulk_b2c(requests_list)
 
-        self.assertIsNone(response)
+        mock_request.assert_not_called()
 
-    def test_handle_successful_result_response(self) -> None:
-        """Tests the handle_successful_result_response() function from the mpesa b2c module"""
-        payment = frappe.db.get_value(
-            "MPesa B2C Payment",
-            {"partyb": "254708993268"},
-            ["originatorconversationid"],
-            as_dict=True,
+    @patch.object(mpesa_connector._SESSION, "request")
+    def test_authentication_client_errors_do_not_open_circuit(
+        self, mock_request: MagicMock
+    ) -> None:
+        """Tests that rejected credentials are not counted as a Daraja outage"""
+        mock_request.return_value = get_response(400)
+
+        for _ in range(mpesa_connector.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(frappe.ValidationError):
+                MpesaB2CConnector().authenticate("Test Mpesa Setting")
+
+        mpesa_connector._check_circuit()
+
+
+@patch.object(
+    MpesaB2CConnector,
+    "_prepare_b2c_payment_request",
+    side_effect=prepare_b2c_payment_request,
+)
+@patch.object(base_classes, "enqueue_b2c_error_log")
+@patch.object(mpesa_connector._SESSION, "request")
+class TestMpesaB2CConnectorPaymentRequest(FrappeTestCase):
+    """Tests for MpesaB2CConnector.make_b2c_payment_request()"""
+
+    def setUp(self) -> None:
+        mpesa_connector._CIRCUIT.update(fails=0, open_until=0.0)
+
+    def test_successful_payment_request(
+        self,
+        mock_request: MagicMock,
+        mock_enqueue: MagicMock,
+        mock_prepare: MagicMock,
+    ) -> None:
+        """Tests that only the expected fields of Daraja's response are returned"""
+        mock_request.return_value = get_response(
+            200, SUCCESSFUL_PAYMENT_RESPONSE | {"Extra": "field"}
         )
-        SUCCESSFUL_TEST_RESULTS["Result"][
-            "OriginatorConversationID"
-        ] = payment.originatorconversationid
 
-        mock_transaction_id = f"{''.join([random.choice(string.ascii_letters) for _ in range(10)])}{random.randint(1000000, 100000000)}"
-        SUCCESSFUL_TEST_RESULTS["Result"]["TransactionID"] = mock_transaction_id
-        SUCCESSFUL_TEST_RESULTS["Result"]["ResultParameters"]["ResultParameter"][1][
-            "Value"
-        ] = mock_transaction_id
+        result = MpesaB2CConnector().make_b2c_payment_request(
+            get_b2c_request_data("paid")
+        )
 
-        result = handle_successful_result_response(SUCCESSFUL_TEST_RESULTS["Result"])
+        self.assertEqual(result.integration_request, "paid")
+        self.assertDictEqual(result.response, SUCCESSFUL_PAYMENT_RESPONSE)
+        self.assertIsNone(result.error)
 
-        self.assertIsInstance(result, Document)
-        self.assertEqual(result.name, mock_transaction_id)
+        method, url = mock_request.call_args.args
+        self.assertEqual(method, "POST")
+        self.assertEqual(url, f"{PAYMENT_REQUEST_URL}?id=paid")
+        mock_enqueue.assert_not_called()
 
-    def test_update_doctype_single_values(self) -> None:
-        """Tests the update_doctype_single_values() function from the b2c payment module"""
-        payment = frappe.db.get_value(
-            "MPesa B2C Payment",
-            {
-                "partyb": "254708993268",
-                "account_paid_from": EXPENSE_ACCOUNT,
-                "account_paid_to": INCOME_ACCOUNT,
-            },
-            ["name", "occassion"],
-            as_dict=True,
+    def test_incomplete_payment_response(
+        self,
+        mock_request: MagicMock,
+        mock_enqueue: MagicMock,
+        mock_prepare: MagicMock,
+    ) -> None:
+        """Tests that expected fields missing from Daraja's response are returned as None"""
+        mock_request.return_value = get_response(
+            200, {"ConversationID": "AG_20191219_00005797af5d7d75f652"}
         )
 
-        self.assertEqual(payment.occassion, "Testing")
+        result = MpesaB2CConnector().make_b2c_payment_request(
+            get_b2c_request_data("paid")
+        )
 
-        new_value = "Unit Testing"
-        update_doctype_single_values(
-            "MPesa B2C Payment", payment, "occassion", new_value
+        self.assertEqual(
+            result.response["ConversationID"], "AG_20191219_00005797af5d7d75f652"
         )
+        self.assertIsNone(result.response["ResponseCode"])
 
-        updated_payment = frappe.db.get_value(
-            "MPesa B2C Payment",
+    def test_failed_payment_request(
+        self,
+        mock_request: MagicMock,
+        mock_enqueue: MagicMock,
+        mock_prepare: MagicMock,
+    ) -> None:
+        """Tests that a failed payment request is logged in the background and raised"""
+        mock_request.return_value = get_response(400, {"errorMessage": "Bad Request"})
+
+        with self.assertRaises(frappe.DataError):
+            MpesaB2CConnector().make_b2c_payment_request(
+                get_b2c_request_data("failing")
+            )
+
+        error, integration_request = mock_enqueue.call_args.args
+        self.assertIsInstance(error, requests.HTTPError)
+        self.assertEqual(integration_request, "failing")
+        self.assertEqual(mock_request.call_count, 1)
+
+
+@patch.object(uninstall.click, "secho")
+@patch.object(uninstall.frappe, "db")
+@patch.object(uninstall.frappe, "get_all")
+class TestUninstall(FrappeTestCase):
+    """Tests for the removal of the app's customisations"""
+
+    @patch.object(
+        uninstall,
+        "fixtures",
+        [
+            {"doctype": "Custom Field", "filters": [["dt", "=", "Salary Slip"]]},
+            {"doctype": "Custom Field", "filters": [["dt", "=", "Mpesa Settings"]]},
+            {"doctype": "Property Setter", "filters": [["doc_type", "=", "Employee"]]},
+        ],
+    )
+    def test_delete_custom_fields(
+        self, mock_get_all: MagicMock, mock_db: MagicMock, mock_secho: MagicMock
+    ) -> None:
+        """Tests that each doctype's customisations are removed with a single delete"""
+        mock_get_all.side_effect = [
+            ["Salary Slip-custom_b2c_disbursed_successfully"],
+            ["Mpesa Settings-custom_b2c_max_retries"],
+            [],
+        ]
+
+        uninstall.delete_custom_fields()
+
+        mock_db.delete.assert_called_once_with(
+            "Custom Field",
             {
-                "partyb": "254708993268",
-                "account_paid_from": EXPENSE_ACCOUNT,
-                "account_paid_to": INCOME_ACCOUNT,
-                "occassion": new_value,
+                "name": (
+                    "in",
+                    [
+                        "Salary Slip-custom_b2c_disbursed_successfully",
+                        "Mpesa Settings-custom_b2c_max_retries",
+                    ],
+                )
             },
-            ["name", "occassion"],
-            as_dict=True,
         )
-        self.assertIsNotNone(updated_payment)
-        self.assertEqual(updated_payment.occassion, new_value)
-
-    def test_validate_receiver_mobile_number(self) -> None:
-        """Tests the validate_receiver_mobile_number() from the b2c payment module"""
-        valid_phone_number1 = "254712345678"
-        valid_phone_number2 = "254112345678"
-        valid_phone_number3 = "254110123456"
-        valid_phone_number4 = "+254712345678"
-
-        invalid_phone_number2 = "2547123456789"
-        invalid_phone_number3 = "25471234567"
-        invalid_phone_number4 = "25471234567a"
-        invalid_phone_number5 = "25411345678901"
-        invalid_phone_number6 = "2541054321a"
-
-        self.assertTrue(validate_receiver_mobile_number(valid_phone_number1))
-        self.assertTrue(validate_receiver_mobile_number(valid_phone_number2))
-        self.assertTrue(validate_receiver_mobile_number(valid_phone_number3))
-        self.assertTrue(validate_receiver_mobile_number(valid_phone_number4))
-
-        self.assertFalse(validate_receiver_mobile_number(invalid_phone_number2))
-        self.assertFalse(validate_receiver_mobile_number(invalid_phone_number3))
-        self.assertFalse(validate_receiver_mobile_number(invalid_phone_number4))
-        self.assertFalse(validate_receiver_mobile_number(invalid_phone_number5))
-        self.assertFalse(validate_receiver_mobile_number(invalid_phone_number6))
-
-    def test_sanitise_phone_number(self) -> None:
-        """Tests the sanitise_phone_number() function from the b2c payment module"""
-        unsatinised_phone_number1 = "0712 345 678"
-        unsatinised_phone_number2 = "+254 712 345 678"
-
-        result1 = sanitise_phone_number(unsatinised_phone_number1)
-        result2 = sanitise_phone_number(unsatinised_phone_number2)
-
-        self.assertEqual(result1, "254712345678")
-        self.assertEqual(result2, "254712345678")
-
-    def test_make_payment(self) -> None:
-        """Tests the make_payment() function from the b2c payment module"""
-        with patch.object(
-            mpesa_b2c_payment, "get_decrypted_password"
-        ) as mock_password, patch.object(
-            mpesa_b2c_payment, "get_file_path"
-        ) as mock_certificate_file, patch.object(
-            mpesa_b2c_payment, "openssl_encrypt_encode"
-        ) as mock_security_credentials, patch.object(
-            mpesa_b2c_payment, "generate_payload"
-        ) as mock_payload, patch.object(
-            mpesa_b2c_payment.requests, "post"
-        ) as mock_response, patch.object(
-            mpesa_b2c_payment.frappe, "msgprint"
-        ) as mock_msgprint, patch.object(
-            mpesa_b2c_payment, "make_payment"
-        ):
-            mock_password.return_value = "password"
-            mock_certificate_file.return_value = "/path/to/certificate.pem"
-            certificate_file = mpesa_b2c_payment.get_certificate_file(
-                "/path/to/certificate.pem"
-            )
+        mock_db.commit.assert_called_once()
 
-            mock_security_credentials.return_value = "security_credentials".encode()
-            encoded_credentials = "security_credentials".encode()
-            credentials = mpesa_b2c_payment.openssl_encrypt_encode(
-                "password".encode(), certificate_file
-            )
+    def test_delete_custom_fields_error(
+        self, mock_get_all: MagicMock, mock_db: MagicMock, mock_secho: MagicMock
+    ) -> None:
+        """Tests that a failed removal is reported and raised without committing"""
+        mock_get_all.side_effect = frappe.ValidationError
 
-            mock_payload.return_value = {"payload": "payload"}
-            payload = mpesa_b2c_payment.generate_payload("", {}, credentials.decode())
+        with self.assertRaises(frappe.ValidationError):
+            uninstall.delete_custom_fields()
 
-            mock_response.return_value.text = {"message": "Success"}
-            mock_response.return_value.status_code = 200
+        mock_db.commit.assert_not_called()
+        self.assertEqual(mock_secho.call_args.kwargs["fg"], "bright_red")
 
-            send_payload(payload, "token", "http://example.org/get-payload")
 
-            mpesa_b2c_payment.make_payment("token", "Document", {}, "Document")
+@patch.object(mpesa_connector, "update_integration_request")
+@patch.object(mpesa_connector.frappe, "cache")
+class TestResultsCallback(FrappeTestCase):
+    """Tests for the Daraja results callback"""
 
-            self.assertEqual(credentials, encoded_credentials)
-            self.assertIsInstance(payload, dict)
-            self.assertDictEqual(payload, {"payload": "payload"})
-            self.assertIsInstance(mock_response.return_value.text, dict)
-            self.assertEqual(mock_response.return_value.text["message"], "Success")
+    def setUp(self) -> None:
+        self.cached_values = {}
 
-            # Retrieving msgprint value after calling make_payment
-            msgprint_args, _ = mock_msgprint.call_args
-            self.assertEqual(msgprint_args[0], "Payment Request Successful")
+    def use_cache(self, mock_cache: MagicMock) -> None:
+        mock_cache.return_value.get_value.side_effect = self.cached_values.get
+        mock_cache.return_value.set_value.side_effect = (
+            lambda key, value, expires_in_sec: self.cached_values.__setitem__(
+                key, value
+            )
+        )
+
+    def test_repeated_callbacks_are_processed_once(
+        self, mock_cache: MagicMock, mock_update: MagicMock
+    ) -> None:
+        """Tests that Daraja's retries of a failure callback are ignored"""
+        self.use_cache(mock_cache)
+        failed_results = {
+            "Result": SUCCESSFUL_TEST_RESULTS["Result"]
+            | {
+                "ResultCode": 2001,
+                "ResultDesc": "The initiator information is invalid.",
+            }
+        }
 
-            mock_msgprint.assert_called_once_with(
-                "Payment Request Successful",
-                title="Successful",
-                indicator="green",
+        mpesa_connector.results_callback_url(**failed_results)
+        mpesa_connector.results_callback_url(**failed_results)
+
+        mock_update.assert_called_once_with(
+            failed_results["Result"]["OriginatorConversationID"],
+            "Failed",
+            output=failed_results["Result"],
+            error="The initiator information is invalid.",
+        )
+        self.assertEqual(
+            mock_cache.return_value.set_value.call_args.kwargs["expires_in_sec"],
+            mpesa_connector.CALLBACK_DEDUPLICATION_WINDOW,
+        )
+
+    def test_distinct_callbacks_are_processed(
+        self, mock_cache: MagicMock, mock_update: MagicMock
+    ) -> None:
+        """Tests that callbacks for different requests are not deduplicated"""
+        self.use_cache(mock_cache)
+
+        for originator_conversation_id in ("first", "second"):
+            mpesa_connector.results_callback_url(
+                Result=SUCCESSFUL_TEST_RESULTS["Result"]
+                | {
+                    "OriginatorConversationID": originator_conversation_id,
+                    "ResultCode": 1,
+                }
             )
+
+        self.assertEqual(mock_update.call_count, 2)
+        self.assertEqual(len(self.cached_values), 2)
+
+    def test_successful_callback_does_not_fail_request(
+        self, mock_cache: MagicMock, mock_update: MagicMock
+    ) -> None:
+        """Tests that a successful result leaves the Integration Request untouched"""
+        self.use_cache(mock_cache)
+
+        mpesa_connector.results_callback_url(**SUCCESSFUL_TEST_RESULTS)
+
+        mock_update.assert_not_called()
+        self.assertEqual(len(self.cached_values), 1)
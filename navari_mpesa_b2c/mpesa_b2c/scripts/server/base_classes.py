@@ -1,10 +1,16 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from collections.abc import Callable
 
 import frappe
 
-from ...utils.helpers import update_integration_request
+from ...utils.definitions import B2CResult
+from ...utils.helpers import enqueue_b2c_error_log
+
+# Bound once as they are looked up on every failure during a Daraja outage
+_throw = frappe.throw
+_DataError = frappe.DataError
 
 
 class ConnectorAbstractClass(ABC):
@@ -19,61 +25,58 @@ class ConnectorAbstractClass(ABC):
         """
 
     @abstractmethod
-    def notify(self) -> None:
-        """Notify all registered observers"""
+    def notify(self, result: B2CResult) -> None:
+        """Notify all registered observers
+
+        Args:
+            result (B2CResult): The result the observers react to
+        """
 
 
 class ConnectorBaseClass(ConnectorAbstractClass):
     """Base class for Connector Classes"""
 
     def __init__(self) -> None:
-        self.error: str | Exception | None = None
-        self.integration_request: str | None = None
-
-        self._observers: list[Observer] = []
+        self._error_handler: Callable[[B2CResult], None] | None = None
 
     def attach(self, observer: Observer) -> None:
-        """Attach Observers
+        """Attach Observers. Only a single observer is kept; attaching another replaces it.
 
         Args:
             observer (Observer): The observer to attach
         """
-        self._observers.append(observer)
+        self._error_handler = observer.update
 
-    def notify(self) -> None:
-        """Notify all registered observers"""
-        for observer in self._observers:
-            observer.update(self)
+    def notify(self, result: B2CResult) -> None:
+        """Notify the registered observer
+
+        Args:
+            result (B2CResult): The result the observer reacts to
+        """
+        if self._error_handler is not None:
+            self._error_handler(result)
 
 
 class Observer(ABC):
     """Observer Abstract Class"""
 
     @abstractmethod
-    def update(self, notifier: ConnectorBaseClass) -> None:
-        """Method that reacts to specific state in the notifier when called
+    def update(self, result: B2CResult) -> None:
+        """Method that reacts to specific state in the result when called
 
         Args:
-            notifier (ConnectorBaseClass): The Notifier (calling class)
+            result (B2CResult): The result passed on by the notifier
         """
 
 
 class ErrorObserver(Observer):
     """Error Observer concrete class"""
 
-    def update(self, notifier: ConnectorBaseClass) -> None:
-        if notifier.error:
-            frappe.log_error(
-                title="HTTPError",
-                message=notifier.error,
-            )
-            update_integration_request(
-                notifier.integration_request,
-                status="Failed",
-                error=str(notifier.error),
-            )
-            frappe.throw(
-                str(notifier.error),
-                frappe.DataError,
+    def update(self, result: B2CResult) -> None:
+        if result.error:
+            enqueue_b2c_error_log(result.error, result.integration_request)
+            _throw(
+                str(result.error),
+                _DataError,
                 title="HTTPError",
             )
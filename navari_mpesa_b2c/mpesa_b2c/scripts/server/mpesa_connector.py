@@ -1,20 +1,70 @@
+import asyncio
+import functools
+import hashlib
+import random
+import threading
+import time
 from datetime import datetime, timedelta
 from enum import Enum
 from urllib.parse import urlparse
 
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.exceptions import InvalidHeader, NewConnectionError
+from urllib3.util.retry import Retry
 
 import frappe
 from frappe.integrations.utils import create_request_log
 from frappe.utils import get_request_site_address
-from frappe.utils.password import get_decrypted_password
 
-from ...utils.definitions import B2CRequestDefinition
-from ...utils.doctype_names import DARAJA_ACCESS_TOKENS_DOCTYPE
-from ...utils.helpers import save_access_token, update_integration_request
+from ...doctype import app_logger
+from ...doctype.custom_exceptions import DarajaCircuitOpenError
+from ...utils.definitions import B2CRequestDefinition, B2CResult
+from ...utils.helpers import (
+    enqueue_access_token_expiry,
+    enqueue_b2c_error_log,
+    get_valid_access_token,
+    save_access_token,
+    update_integration_request,
+)
 from .base_classes import ConnectorBaseClass, ErrorObserver
 
+RETRIABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# Statuses with which Daraja turns a request away unprocessed. Only these are retried
+# for requests that are not idempotent, i.e. payment requests
+UNPROCESSED_STATUS_CODES = frozenset({429, 503})
+
+# Only used for its Retry-After parsing, which accepts seconds and HTTP dates
+_RETRY_AFTER_PARSER = Retry(total=0)
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+JITTER = 0.5
+
+# Token requests are made from web requests, so their retries are bounded in time
+AUTHENTICATION_TIMEOUT = 30  # seconds, per attempt
+AUTHENTICATION_TOTAL_TIMEOUT = 60  # seconds, after which no further attempt is made
+
+# Fields of the synchronous payment request response that callers rely on
+_EXPECTED_KEYS = (
+    "ConversationID",
+    "OriginatorConversationID",
+    "ResponseCode",
+    "ResponseDescription",
+)
+
+CALLBACK_DEDUPLICATION_WINDOW = 600  # seconds
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_DURATION = 60  # seconds
+
+ASYNC_CLIENT_TIMEOUT = httpx.Timeout(60.0)
+ASYNC_CLIENT_LIMITS = httpx.Limits(max_connections=50)
+
 
 class URLS(Enum):
     """URLS Constant Exporting class"""
@@ -23,73 +73,432 @@ class URLS(Enum):
     PRODUCTION = "https://api.safaricom.co.ke"
 
 
+_BASE_URLS: dict[str, str] = {
+    "sandbox": URLS.SANDBOX.value,
+    "production": URLS.PRODUCTION.value,
+}
+
+
+# Shared session so that TCP connections and TLS sessions to Daraja are reused
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+
+TOKEN_EXPIRY_MARGIN = timedelta(seconds=30)
+
+# Valid access tokens keyed by (site, Mpesa Settings name)
+_TOKEN_CACHE: dict[tuple[str, str], tuple[str, datetime]] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def _get_cached_token(setting: str) -> str | None:
+    """Returns the cached access token for the setting if it is still valid
+
+    Args:
+        setting (str): The Mpesa Settings record the token belongs to
+
+    Returns:
+        str | None: The access token, or None if absent or about to expire
+    """
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get((frappe.local.site, setting))
+
+    if cached and cached[1] > datetime.now() + TOKEN_EXPIRY_MARGIN:
+        return cached[0]
+
+    return None
+
+
+def _cache_token(setting: str, token: str, expiry_time: datetime) -> None:
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[(frappe.local.site, setting)] = (token, expiry_time)
+
+
+def _invalidate_cached_token(setting: str) -> None:
+    """Drops a setting's access token after Daraja rejected it, both from the
+    process cache and from the database so that the next request authenticates anew.
+    The database update is enqueued as the current transaction may be rolled back.
+
+    Args:
+        setting (str): The Mpesa Settings record the token belongs to
+    """
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.pop((frappe.local.site, setting), None)
+
+    enqueue_access_token_expiry(setting)
+
+
+@functools.lru_cache(maxsize=32)
+def _callback_url(site: str) -> str:
+    """Builds the Daraja callback URL for a site. The site argument only keys the cache,
+    as a worker process may serve several sites.
+
+    Args:
+        site (str): The current site
+
+    Returns:
+        str: The callback URL
+    """
+    return f"https://{urlparse(get_request_site_address(full_address=True)).hostname}/api/method/navari_mpesa_b2c.mpesa_b2c.scripts.server.mpesa_connector.results_callback_url"
+
+
+def _extract_payment_response(content: bytes) -> dict[str, str | None]:
+    """Parses a payment request response, keeping only the expected keys
+
+    Args:
+        content (bytes): The raw response body
+
+    Returns:
+        dict[str, str | None]: The expected keys and their values
+    """
+    data = orjson.loads(content)
+
+    return {key: data.get(key) for key in _EXPECTED_KEYS}
+
+
+# Consecutive Daraja failures, and the time until which requests are short-circuited
+_CIRCUIT: dict[str, int | float] = {"fails": 0, "open_until": 0.0}
+_CIRCUIT_LOCK = threading.Lock()
+
+
+def _check_circuit() -> None:
+    """Raises if the circuit is open, i.e. Daraja recently failed repeatedly
+
+    Raises:
+        DarajaCircuitOpenError: If the circuit is open
+    """
+    with _CIRCUIT_LOCK:
+        open_until = _CIRCUIT["open_until"]
+
+    if time.time() < open_until:
+        raise DarajaCircuitOpenError(
+            "Daraja is currently unavailable after repeated failures. Please try again later."
+        )
+
+
+def _record_success() -> None:
+    with _CIRCUIT_LOCK:
+        _CIRCUIT["fails"] = 0
+
+
+def _record_failure(status_code: int | None = None) -> None:
+    """Counts a failed Daraja request towards opening the circuit. Error responses
+    that are not transient, e.g. a 400 for a bad payload, are not counted.
+
+    Args:
+        status_code (int | None): The status code of the error response, if any
+    """
+    if status_code is not None and status_code not in RETRIABLE_STATUS_CODES:
+        return
+
+    with _CIRCUIT_LOCK:
+        _CIRCUIT["fails"] += 1
+
+        if _CIRCUIT["fails"] >= CIRCUIT_FAILURE_THRESHOLD:
+            _CIRCUIT["open_until"] = time.time() + CIRCUIT_OPEN_DURATION
+            _CIRCUIT["fails"] = 0
+
+
+def _backoff_delay(
+    attempt: int,
+    base_delay: float,
+    max_delay: float,
+    jitter: float,
+    retry_after: str | None = None,
+) -> float:
+    """Computes the delay before the next attempt. A valid Retry-After header value
+    is honoured up to max_delay, otherwise a capped exponential delay with jitter is used.
+
+    Args:
+        attempt (int): The zero-based number of the failed attempt
+        base_delay (float): The delay, in seconds, before the first retry
+        max_delay (float): The upper bound, in seconds, of the Retry-After and exponential delays
+        jitter (float): The maximum fraction of the exponential delay randomly added to it
+        retry_after (str | None): The Retry-After header of the failed response, if any
+
+    Returns:
+        float: The delay in seconds
+    """
+    if retry_after:
+        try:
+            return min(max_delay, _RETRY_AFTER_PARSER.parse_retry_after(retry_after))
+
+        except InvalidHeader:
+            pass
+
+    return min(max_delay, base_delay * 2**attempt) * (1 + random.uniform(0, jitter))
+
+
+def _log_retry(url: str, attempt: int, delay: float, status_code: int | None) -> None:
+    app_logger.warning(
+        {
+            "message": "Retrying Daraja request",
+            "url": url,
+            "attempt": attempt + 1,
+            "delay": delay,
+            "status_code": status_code,
+        }
+    )
+
+
+# httpx errors raised before a request is sent
+_ASYNC_CONNECTION_FAILURES = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.PoolTimeout,
+)
+
+
+def _failed_to_connect(error: requests.RequestException) -> bool:
+    """Checks whether a request failed before it was sent, i.e. while connecting
+
+    Args:
+        error (requests.RequestException): The error the request failed with
+
+    Returns:
+        bool: True if no connection could be established
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+
+    return isinstance(reason, NewConnectionError)
+
+
+def _request_with_backoff(
+    method: str,
+    url: str,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    base_delay: float = DEFAULT_BASE_DELAY,
+    max_delay: float = MAX_DELAY,
+    jitter: float = JITTER,
+    idempotent: bool = True,
+    total_timeout: float | None = None,
+    **kwargs,
+) -> requests.Response:
+    """Sends a request, retrying with exponential backoff and jitter on transient errors,
+    i.e. connection errors, timeouts, and the status codes in RETRIABLE_STATUS_CODES.
+    Any other error response is raised immediately. A Retry-After header on the
+    error response takes precedence over the computed delay.
+
+    Requests that are not idempotent are only retried when they provably never reached
+    Daraja, i.e. on failures to connect and the status codes in UNPROCESSED_STATUS_CODES,
+    as retrying them otherwise could pay out twice.
+
+    Args:
+        method (str): The HTTP method
+        url (str): The URL to send the request to
+        max_retries (int): The maximum number of attempts. At least one attempt is made
+        base_delay (float): The delay, in seconds, before the first retry
+        max_delay (float): The upper bound, in seconds, of the delay between attempts
+        jitter (float): The maximum fraction of the delay randomly added to it
+        idempotent (bool): Whether the request can safely be repeated
+        total_timeout (float | None): The time, in seconds, after which no further
+        attempt is started. Unbounded if None
+        **kwargs: Keyword arguments passed on to requests.Session.request()
+
+    Returns:
+        requests.Response: The successful response
+    """
+    max_retries = max(1, max_retries)
+    retriable_status_codes = (
+        RETRIABLE_STATUS_CODES if idempotent else UNPROCESSED_STATUS_CODES
+    )
+    started = time.monotonic()
+
+    for attempt in range(max_retries):
+        status_code = None
+        retry_after = None
+
+        try:
+            response = _SESSION.request(method, url, **kwargs)
+            response.raise_for_status()
+
+            return response
+
+        except requests.HTTPError as e:
+            status_code = e.response.status_code
+            retry_after = e.response.headers.get("Retry-After")
+
+            if status_code not in retriable_status_codes or attempt == max_retries - 1:
+                raise
+
+            error = e
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not (idempotent or _failed_to_connect(e)) or attempt == max_retries - 1:
+                raise
+
+            error = e
+
+        delay = _backoff_delay(attempt, base_delay, max_delay, jitter, retry_after)
+
+        if (
+            total_timeout is not None
+            and time.monotonic() - started + delay >= total_timeout
+        ):
+            raise error
+
+        _log_retry(url, attempt, delay, status_code)
+        time.sleep(delay)
+
+
+async def _async_request_with_backoff(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    base_delay: float = DEFAULT_BASE_DELAY,
+    max_delay: float = MAX_DELAY,
+    jitter: float = JITTER,
+    idempotent: bool = True,
+    **kwargs,
+) -> httpx.Response:
+    """Asynchronous counterpart of _request_with_backoff() for httpx clients
+
+    Args:
+        client (httpx.AsyncClient): The client used to send the request
+        method (str): The HTTP method
+        url (str): The URL to send the request to
+        max_retries (int): The maximum number of attempts. At least one attempt is made
+        base_delay (float): The delay, in seconds, before the first retry
+        max_delay (float): The upper bound, in seconds, of the delay between attempts
+        jitter (float): The maximum fraction of the delay randomly added to it
+        idempotent (bool): Whether the request can safely be repeated
+        **kwargs: Keyword arguments passed on to httpx.AsyncClient.request()
+
+    Returns:
+        httpx.Response: The successful response
+    """
+    max_retries = max(1, max_retries)
+    retriable_status_codes = (
+        RETRIABLE_STATUS_CODES if idempotent else UNPROCESSED_STATUS_CODES
+    )
+
+    for attempt in range(max_retries):
+        status_code = None
+        retry_after = None
+
+        try:
+            response = await client.request(method, url, **kwargs)
+            response.raise_for_status()
+
+            return response
+
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code
+            retry_after = e.response.headers.get("Retry-After")
+
+            if status_code not in retriable_status_codes or attempt == max_retries - 1:
+                raise
+
+        except httpx.TransportError as e:
+            if (
+                not (idempotent or isinstance(e, _ASYNC_CONNECTION_FAILURES))
+                or attempt == max_retries - 1
+            ):
+                raise
+
+        delay = _backoff_delay(attempt, base_delay, max_delay, jitter, retry_after)
+        _log_retry(url, attempt, delay, status_code)
+        await asyncio.sleep(delay)
+
+
 class MpesaB2CConnector(ConnectorBaseClass):
-    """MPesa B2C Connector Class"""
+    """MPesa B2C Connector Class. Instances hold configuration only, so a single
+    connector can be shared across payment requests, see get_connector()."""
 
     def __init__(
         self,
         env: str = "sandbox",
         app_key: bytes | str | None = None,
         app_secret: bytes | str | None = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_delay: float = DEFAULT_BASE_DELAY,
     ) -> None:
-        """Setup configuration for Mpesa connector and generate new access token."""
+        """Setup configuration for Mpesa connector."""
         super().__init__()
 
-        self.authentication_token = None
-        self.expires_in = None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
 
         self.env = env
         self.app_key = app_key
         self.app_secret = app_secret
 
-        if env == "sandbox":
-            self.base_url = URLS.SANDBOX.value
-        else:
-            self.base_url = URLS.PRODUCTION.value
+        self.base_url = _BASE_URLS.get(env, URLS.PRODUCTION.value)
 
-        self.attach(ErrorObserver())
+        self._error_handler = ErrorObserver().update
 
-    def authenticate(self, setting: str) -> dict[str, str | datetime] | None:
+    def authenticate(
+        self,
+        setting: str,
+        app_key: bytes | str | None = None,
+        app_secret: bytes | str | None = None,
+    ) -> dict[str, str | datetime] | None:
         """Authenticate at following endpoint:
         https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials (for sandbox)
 
         Args:
             setting (str): The Mpesa Settings record to fetch Credentials from
+            app_key (bytes | str | None): The Consumer Key. Defaults to the connector's app_key
+            app_secret (bytes | str | None): The Consumer Secret. Defaults to the connector's app_secret
 
         Returns:
             dict[str, str | datetime] | None: The fetched response if request was successful.
             Otherwise an error is raised.
+
+        Raises:
+            DarajaCircuitOpenError: If Daraja requests are currently short-circuited
         """
+        _check_circuit()
+
         authenticate_uri = "/oauth/v1/generate?grant_type=client_credentials"
         authenticate_url = f"{self.base_url}{authenticate_uri}"
 
-        r = requests.get(
-            authenticate_url,
-            auth=HTTPBasicAuth(self.app_key, self.app_secret),
-            timeout=120,
-        )
+        try:
+            r = _request_with_backoff(
+                "GET",
+                authenticate_url,
+                max_retries=self.max_retries,
+                base_delay=self.base_delay,
+                total_timeout=AUTHENTICATION_TOTAL_TIMEOUT,
+                auth=HTTPBasicAuth(
+                    app_key or self.app_key, app_secret or self.app_secret
+                ),
+                timeout=AUTHENTICATION_TIMEOUT,
+            )
+
+        except requests.HTTPError as e:
+            r = e.response
+            _record_failure(r.status_code)
+
+        except (requests.ConnectionError, requests.Timeout):
+            _record_failure()
+            raise
 
         if r.status_code < 400:
             # Success state
-            response = r.json()
+            _record_success()
+            response = orjson.loads(r.content)
 
-            self.authentication_token = response["access_token"]
-            self.expires_in = datetime.now() + timedelta(
-                seconds=int(response["expires_in"])
-            )
+            access_token = response["access_token"]
+            expires_in = datetime.now() + timedelta(seconds=int(response["expires_in"]))
             fetch_time = datetime.now()
 
+            _cache_token(setting, access_token, expires_in)
+
             # Save access token details
             save_access_token(
-                token=self.authentication_token,
-                expiry_time=self.expires_in,
+                token=access_token,
+                expiry_time=expires_in,
                 fetch_time=fetch_time,
                 associated_setting=setting,
             )
 
             return {
-                "access_token": self.authentication_token,
-                "expires_in": self.expires_in,
+                "access_token": access_token,
+                "expires_in": expires_in,
                 "fetched_time": fetch_time,
             }
 
@@ -99,9 +508,7 @@ class MpesaB2CConnector(ConnectorBaseClass):
             title="Error",
         )
 
-    def make_b2c_payment_request(
-        self, request_data: B2CRequestDefinition
-    ) -> str | None:
+    def make_b2c_payment_request(self, request_data: B2CRequestDefinition) -> B2CResult:
         """Initiates a B2C Payment Request to Daraja at following link:
         https://sandbox.safaricom.co.ke/mpesa/b2c/v3/paymentrequest (for sandbox)
 
@@ -109,36 +516,234 @@ class MpesaB2CConnector(ConnectorBaseClass):
             request_data (B2CRequestDefinition): The data used to generate the request JSON
 
         Returns:
-            str | None: The Initial response after making the request
+            B2CResult: The Initial response after making the request, and its Integration Request
+
+        Raises:
+            DarajaCircuitOpenError: If Daraja requests are currently short-circuited
         """
-        # Check if valid Access Token exists
-        token = frappe.db.get_value(
-            DARAJA_ACCESS_TOKENS_DOCTYPE,
-            {
-                "associated_settings": request_data.Setting,
-                "expiry_time": [">", datetime.now()],
-            },
-            ["name", "access_token"],
-            as_dict=True,
+        _check_circuit()
+
+        saf_url, payload, headers, integration_request = (
+            self._prepare_b2c_payment_request(request_data)
         )
 
-        if not token:
-            # If no valid token is present in DB
-            self.app_key = request_data.ConsumerKey
-            self.app_secret = request_data.ConsumerSecret
-
-            # Fetch and save credentials
-            self.authentication_token = self.authenticate(request_data.Setting)[
-                "access_token"
-            ]
-
-        else:
-            self.authentication_token = get_decrypted_password(
-                DARAJA_ACCESS_TOKENS_DOCTYPE, token.name, "access_token"
+        try:
+            response = _request_with_backoff(
+                "POST",
+                saf_url,
+                max_retries=self.max_retries,
+                base_delay=self.base_delay,
+                idempotent=False,
+                data=payload,
+                headers=headers,
+                timeout=60,
             )
 
+        except (requests.HTTPError, requests.ConnectionError, requests.Timeout) as e:
+            status_code = (
+                e.response.status_code if isinstance(e, requests.HTTPError) else None
+            )
+
+            if status_code == 401:
+                _invalidate_cached_token(request_data.Setting)
+
+            _record_failure(status_code)
+
+            result = B2CResult(integration_request=integration_request, error=e)
+            self.notify(result)
+
+            return result
+
+        _record_success()
+
+        return B2CResult(
+            integration_request=integration_request,
+            response=_extract_payment_response(response.content),
+        )
+
+    async def make_b2c_payment_request_async(
+        self,
+        prepared_request: tuple[str, str, dict[str, str], str],
+        client: httpx.AsyncClient,
+    ) -> B2CResult:
+        """Asynchronous counterpart of make_b2c_payment_request() for a request already
+        prepared with _prepare_b2c_payment_request(). Only the HTTP round trip to Daraja is
+        awaited on the supplied client so that several requests can be in flight at once.
+        Errors are returned in the result instead of notifying observers.
+
+        Args:
+            prepared_request (tuple[str, str, dict[str, str], str]): The request URL, payload,
+            headers, and Integration Request name
+            client (httpx.AsyncClient): The client used to send the request
+
+        Returns:
+            B2CResult: The Initial response after making the request, and its Integration Request
+        """
+        saf_url, payload, headers, integration_request = prepared_request
+
+        try:
+            response = await _async_request_with_backoff(
+                client,
+                "POST",
+                saf_url,
+                max_retries=self.max_retries,
+                base_delay=self.base_delay,
+                idempotent=False,
+                content=payload,
+                headers=headers,
+            )
+
+        except httpx.HTTPError as e:
+            _record_failure(
+                e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            )
+
+            return B2CResult(integration_request=integration_request, error=e)
+
+        _record_success()
+
+        return B2CResult(
+            integration_request=integration_request,
+            response=_extract_payment_response(response.content),
+        )
+
+    def bulk_b2c(self, requests_list: list[B2CRequestDefinition]) -> list[B2CResult]:
+        """Initiates several B2C Payment Requests concurrently. Access tokens and
+        Integration Requests are resolved beforehand so that only the requests to Daraja
+        run on the event loop, and so that authentication happens once per batch.
+        Failed requests are logged and returned in their results rather than raised,
+        since the other requests of the batch may already have been accepted by Daraja.
+
+        Args:
+            requests_list (list[B2CRequestDefinition]): The data used to generate each request
+
+        Returns:
+            list[B2CResult]: The results, in the same order as requests_list
+
+        Raises:
+            DarajaCircuitOpenError: If Daraja requests are currently short-circuited
+        """
+        _check_circuit()
+
+        # Failing to get a token fails the whole batch, before any request is sent
+        access_tokens: dict[str, str] = {}
+        for request_data in requests_list:
+            if request_data.Setting not in access_tokens:
+                access_tokens[request_data.Setting] = self._get_access_token(
+                    request_data
+                )
+
+        results: list[B2CResult | None] = [None] * len(requests_list)
+        prepared_requests: dict[int, tuple[str, str, dict[str, str], str]] = {}
+
+        for index, request_data in enumerate(requests_list):
+            try:
+                prepared_requests[index] = self._prepare_b2c_payment_request(
+                    request_data, access_tokens[request_data.Setting]
+                )
+
+            except Exception as e:
+                # e.g. a duplicate Integration Request. The rest of the batch is still sent
+                results[index] = B2CResult(integration_request=None, error=e)
+
+        if prepared_requests:
+            sent_results = asyncio.run(
+                self._bulk_b2c_async(list(prepared_requests.values()))
+            )
+
+            for index, result in zip(prepared_requests, sent_results):
+                results[index] = result
+
+        rejected_settings = set()
+
+        for request_data, result in zip(requests_list, results):
+            if not result.error:
+                continue
+
+            enqueue_b2c_error_log(result.error, result.integration_request)
+
+            if (
+                isinstance(result.error, httpx.HTTPStatusError)
+                and result.error.response.status_code == 401
+            ):
+                rejected_settings.add(request_data.Setting)
+
+        for setting in rejected_settings:
+            _invalidate_cached_token(setting)
+
+        return results
+
+    async def _bulk_b2c_async(
+        self, prepared_requests: list[tuple[str, str, dict[str, str], str]]
+    ) -> list[B2CResult]:
+        async with httpx.AsyncClient(
+            timeout=ASYNC_CLIENT_TIMEOUT, limits=ASYNC_CLIENT_LIMITS
+        ) as client:
+            # Exceptions are collected so that one failing request does not cancel the
+            # others that may already be in flight
+            results = await asyncio.gather(
+                *[
+                    self.make_b2c_payment_request_async(prepared_request, client)
+                    for prepared_request in prepared_requests
+                ],
+                return_exceptions=True,
+            )
+
+        return [
+            (
+                result
+                if isinstance(result, B2CResult)
+                else B2CResult(integration_request=prepared_request[3], error=result)
+            )
+            for prepared_request, result in zip(prepared_requests, results)
+        ]
+
+    def _get_access_token(self, request_data: B2CRequestDefinition) -> str:
+        """Returns a valid access token for the request's setting, authenticating if none exists
+
+        Args:
+            request_data (B2CRequestDefinition): The request whose setting and credentials are used
+
+        Returns:
+            str: The access token
+        """
+        access_token = _get_cached_token(request_data.Setting)
+
+        if access_token:
+            return access_token
+
+        # Check if valid Access Token exists
+        token = get_valid_access_token(request_data.Setting)
+
+        if not token:
+            # If no valid token is present in DB, fetch and save credentials
+            return self.authenticate(
+                request_data.Setting,
+                app_key=request_data.ConsumerKey,
+                app_secret=request_data.ConsumerSecret,
+            )["access_token"]
+
+        _cache_token(request_data.Setting, token.access_token, token.expiry_time)
+
+        return token.access_token
+
+    def _prepare_b2c_payment_request(
+        self, request_data: B2CRequestDefinition, access_token: str | None = None
+    ) -> tuple[str, str, dict[str, str], str]:
+        """Resolves the access token, builds the request and logs the Integration Request.
+
+        Args:
+            request_data (B2CRequestDefinition): The data used to generate the request JSON
+            access_token (str | None): The access token to use. Resolved if not supplied
+
+        Returns:
+            tuple[str, str, dict[str, str], str]: The request URL, payload, headers,
+            and Integration Request name
+        """
+        access_token = access_token or self._get_access_token(request_data)
+
         saf_url = f"{self.base_url}/mpesa/b2c/v3/paymentrequest"
-        callback_url = f"https://{urlparse(get_request_site_address(full_address=True)).hostname}/api/method/navari_mpesa_b2c.mpesa_b2c.scripts.server.mpesa_connector.results_callback_url"
+        callback_url = _callback_url(frappe.local.site)
         payload = request_data.to_json(
             {
                 "QueueTimeOutURL": callback_url,
@@ -146,12 +751,12 @@ class MpesaB2CConnector(ConnectorBaseClass):
             }
         )
         headers = {
-            "Authorization": f"Bearer {self.authentication_token}",
+            "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json",
         }
 
         # Create Integration Request
-        self.integration_request = create_request_log(
+        integration_request = create_request_log(
             url=saf_url,
             is_remote_request=1,
             data=payload,
@@ -161,33 +766,50 @@ class MpesaB2CConnector(ConnectorBaseClass):
             request_headers=headers,
         ).name
 
-        try:
-            response = requests.post(
-                saf_url,
-                data=payload,
-                headers=headers,
-                timeout=60,
-            )
+        return saf_url, payload, headers, integration_request
 
-            response.raise_for_status()
 
-        except (requests.HTTPError, requests.ConnectionError) as e:
-            self.error = e
-            self.notify()
+@functools.lru_cache(maxsize=32)
+def get_connector(
+    env: str = "sandbox",
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    base_delay: float = DEFAULT_BASE_DELAY,
+) -> MpesaB2CConnector:
+    """Returns a shared connector for the given configuration
+
+    Args:
+        env (str): The Daraja environment, i.e. sandbox or production
+        max_retries (int): The maximum number of attempts per request
+        base_delay (float): The delay, in seconds, before the first retry
 
-        return response.json()
+    Returns:
+        MpesaB2CConnector: The connector
+    """
+    return MpesaB2CConnector(env=env, max_retries=max_retries, base_delay=base_delay)
 
 
 @frappe.whitelist(allow_guest=True)
 def results_callback_url(**kwargs) -> None:
     """Callback URL"""
-    result = frappe._dict(kwargs["Result"])
+    result = kwargs["Result"]
+
+    # Safaricom retries callbacks; skip ones already processed
+    fingerprint = hashlib.blake2b(
+        f"{result['OriginatorConversationID']}:{result['ResultCode']}".encode(),
+        digest_size=8,
+    ).hexdigest()
+    cache_key = f"b2c_cb:{fingerprint}"
 
-    if result.ResultCode != 0:
+    if frappe.cache().get_value(cache_key):
+        return
+
+    if result["ResultCode"] != 0:
         # If Failure Response
         update_integration_request(
-            result.OriginatorConversationID,
+            result["OriginatorConversationID"],
             "Failed",
             output=result,
-            error=result.ResultDesc,
+            error=result["ResultDesc"],
         )
+
+    frappe.cache().set_value(cache_key, 1, expires_in_sec=CALLBACK_DEDUPLICATION_WINDOW)
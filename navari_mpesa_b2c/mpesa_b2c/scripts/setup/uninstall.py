@@ -9,10 +9,20 @@ def delete_custom_fields():
     click.secho("Removing customisations", fg="green")
 
     try:
-        frappe.db.delete(
-            doctype=fixtures[0]["doctype"],
-            filters=fixtures[0]["filters"],
-        )
+        names_by_doctype: dict[str, list[str]] = {}
+
+        for fixture in fixtures:
+            names_by_doctype.setdefault(fixture["doctype"], []).extend(
+                frappe.get_all(
+                    fixture["doctype"], filters=fixture["filters"], pluck="name"
+                )
+            )
+
+        for doctype, names in names_by_doctype.items():
+            if names:
+                frappe.db.delete(doctype, {"name": ("in", names)})
+
+        frappe.db.commit()
 
     except Exception as e:
         click.secho(
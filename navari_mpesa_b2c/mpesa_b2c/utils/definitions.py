@@ -1,6 +1,7 @@
-import json
 from dataclasses import asdict, dataclass
 
+import orjson
+
 
 @dataclass(init=True, frozen=True)
 class B2CRequestDefinition:
@@ -50,4 +51,13 @@ class B2CRequestDefinition:
         Returns:
             str: The JSON representation of the dataclass values
         """
-        return json.dumps(self.to_dict(with_dict))
+        return orjson.dumps(self.to_dict(with_dict)).decode()
+
+
+@dataclass(init=True, frozen=True)
+class B2CResult:
+    """Dataclass bearing the outcome of a B2C Payment Request"""
+
+    integration_request: str | None
+    response: dict | None = None
+    error: Exception | None = None
@@ -1,10 +1,19 @@
 from datetime import datetime
 from typing import Literal
 
+import orjson
+
 import frappe
+from frappe.query_builder import Order, Table
+from frappe.query_builder.functions import Cast_
+from frappe.utils.password import decrypt
 
 from .doctype_names import DARAJA_ACCESS_TOKENS_DOCTYPE
 
+# Bound once as they are looked up on every failure during a Daraja outage
+_log_error = frappe.log_error
+_enqueue = frappe.enqueue
+
 
 def save_access_token(
     token: str,
@@ -23,7 +32,6 @@ def save_access_token(
 
     try:
         doc.save(ignore_permissions=True)
-        doc.submit()
 
         return True
 
@@ -33,14 +41,152 @@ def save_access_token(
         return False
 
 
+def get_valid_access_token(
+    associated_setting: str,
+    doctype: str = DARAJA_ACCESS_TOKENS_DOCTYPE,
+) -> frappe._dict | None:
+    """Fetches the latest unexpired access token of a setting together with its
+    encrypted password in a single query
+
+    Args:
+        associated_setting (str): The Mpesa Settings record the token belongs to
+        doctype (str): The access tokens doctype
+
+    Returns:
+        frappe._dict | None: The decrypted access_token and its expiry_time, if any
+    """
+    tokens = frappe.qb.DocType(doctype)
+    auth = Table("__Auth")
+
+    token = (
+        frappe.qb.from_(tokens)
+        .inner_join(auth)
+        .on(
+            (auth.doctype == doctype)
+            # Token names are autoincremented integers, __Auth names are varchars
+            & (auth.name == Cast_(tokens.name, "varchar"))
+            & (auth.fieldname == "access_token")
+            & (auth.encrypted == 1)
+        )
+        .select(tokens.expiry_time, auth.password.as_("access_token"))
+        .where(
+            (tokens.associated_settings == associated_setting)
+            & (tokens.expiry_time > datetime.now())
+        )
+        .orderby(tokens.expiry_time, order=Order.desc)
+        .limit(1)
+        .run(as_dict=True)
+    )
+
+    if not token:
+        return None
+
+    token = token[0]
+    token.access_token = decrypt(token.access_token)
+
+    return token
+
+
+def expire_access_tokens(
+    associated_setting: str,
+    doctype: str = DARAJA_ACCESS_TOKENS_DOCTYPE,
+) -> None:
+    """Marks a setting's unexpired access tokens as expired, e.g. after Daraja rejected them
+
+    Args:
+        associated_setting (str): The Mpesa Settings record the tokens belong to
+        doctype (str): The access tokens doctype
+    """
+    now = datetime.now()
+
+    frappe.db.set_value(
+        doctype,
+        {"associated_settings": associated_setting, "expiry_time": [">", now]},
+        "expiry_time",
+        now,
+        update_modified=False,
+    )
+
+
+def enqueue_access_token_expiry(associated_setting: str) -> None:
+    """Enqueues expire_access_tokens() for a setting whose token Daraja rejected.
+    The job is enqueued immediately rather than after commit, so it survives a rollback
+    of the current transaction.
+
+    Args:
+        associated_setting (str): The Mpesa Settings record the tokens belong to
+    """
+    _enqueue(
+        "navari_mpesa_b2c.mpesa_b2c.utils.helpers.expire_access_tokens",
+        queue="short",
+        associated_setting=associated_setting,
+    )
+
+
+def delete_expired_access_tokens(
+    doctype: str = DARAJA_ACCESS_TOKENS_DOCTYPE,
+) -> None:
+    """Scheduled job removing expired access tokens and their stored passwords"""
+    expired_tokens = frappe.get_all(
+        doctype, filters={"expiry_time": ["<", datetime.now()]}, pluck="name"
+    )
+
+    if expired_tokens:
+        frappe.db.delete(doctype, {"name": ("in", expired_tokens)})
+        frappe.db.delete(
+            "__Auth",
+            {
+                "doctype": doctype,
+                "name": ("in", [str(name) for name in expired_tokens]),
+            },
+        )
+
+
 def update_integration_request(
     integration_request: str,
     status: Literal["Completed", "Failed"],
-    output: str | None = None,
+    output: dict | str | None = None,
     error: str | None = None,
 ) -> None:
-    doc = frappe.get_doc("Integration Request", integration_request, for_update=True)
-    doc.status = status
-    doc.error = error
-    doc.output = output
-    doc.save(ignore_permissions=True)
+    """Overwrites the status, error, and output of an Integration Request.
+    This is a blind write that does not depend on the row's current state, so it is
+    idempotent under repeated callbacks and takes no row lock. A dict output is stored
+    as JSON, a str output as is."""
+    if isinstance(output, dict):
+        output = orjson.dumps(output).decode()
+
+    frappe.db.set_value(
+        "Integration Request",
+        integration_request,
+        {"status": status, "error": error, "output": output or None},
+        update_modified=True,
+    )
+
+
+def enqueue_b2c_error_log(
+    error: str | Exception, integration_request: str | None
+) -> None:
+    """Enqueues _log_b2c_error() for a failed Daraja request. The job is enqueued
+    immediately rather than after commit, so it survives a rollback of the current
+    transaction.
+
+    Args:
+        error (str | Exception): The error the request failed with
+        integration_request (str | None): The request's Integration Request, if one was created
+    """
+    _enqueue(
+        "navari_mpesa_b2c.mpesa_b2c.utils.helpers._log_b2c_error",
+        queue="short",
+        title="HTTPError",
+        message=str(error),
+        integration_request=integration_request,
+    )
+
+
+def _log_b2c_error(title: str, message: str, integration_request: str | None) -> None:
+    """Background job recording a failed Daraja request in the Error Log
+    and marking its Integration Request as Failed"""
+    _log_error(title=title, message=message)
+
+    if integration_request:
+        update_integration_request(integration_request, status="Failed", error=message)